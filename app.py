@@ -1,7 +1,9 @@
 import os
+import asyncio
 import logging
 import random
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from typing import Optional
 
@@ -10,6 +12,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
 from t5qg import T5
+from t5qg.exceptions import AnswerNotFoundError
 
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.DEBUG, datefmt='%Y-%m-%d %H:%M:%S')
 
@@ -18,14 +21,117 @@ logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logg
 MODEL = os.getenv('MODEL', 'asahi417/question-generation-squad-t5-small')
 MAX_LENGTH = int(os.getenv('MAX_LENGTH', 512))
 MAX_LENGTH_OUTPUT = int(os.getenv('MAX_LENGTH_OUTPUT', 32))
-qg_model = T5(MODEL, MAX_LENGTH, MAX_LENGTH_OUTPUT)
+MAX_BATCH = int(os.getenv('MAX_BATCH', 32))
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', 16))
+BATCH_TIMEOUT = float(os.getenv('BATCH_TIMEOUT', 0.01))
+COMPILE = bool(int(os.getenv('COMPILE', 0)))
+NUM_BEAM = int(os.getenv('NUM_BEAM', 2))
+QUANT = os.getenv('QUANT', None)
+QA_CACHE_SIZE = int(os.getenv('QA_CACHE_SIZE', 1024))
+ONNX = bool(int(os.getenv('ONNX', 0)))
+HALF_PRECISION = os.getenv('HALF_PRECISION', 'bf16') or None  # empty to disable
+# the model is instantiated (and warmed up) and run on the same thread, as the cuda graph is kept per thread
+executor = ThreadPoolExecutor(max_workers=1)
+qg_model = executor.submit(
+    T5, MODEL, MAX_LENGTH, MAX_LENGTH_OUTPUT, compile_model=COMPILE, quantization=QUANT, qa_cache_size=QA_CACHE_SIZE,
+    onnx=ONNX, warmup_num_beams=NUM_BEAM, warmup_batch_size=BATCH_SIZE, half_precision=HALF_PRECISION).result()
 
 
 # Run app
 class ModelInput(BaseModel):
     input_text: str
     highlight: Optional[str] = None
-    num_beam: int = 4
+    num_beam: int = NUM_BEAM
+    early_stopping: bool = True
+    no_repeat_ngram_size: Optional[int] = 3
+
+
+def decoding_config(model_input):
+    """ Decoding parameters of the request as the keyword arguments of the model. """
+    return {'num_beams': model_input.num_beam,
+            'early_stopping': model_input.early_stopping,
+            'no_repeat_ngram_size': model_input.no_repeat_ngram_size}
+
+
+def generate(list_model_input):
+    """ Run the model over a batch of requests. Requests sharing the same decoding parameters are processed together,
+    by a single `generate_qa_batch` call for the requests without highlight and a single `generate_q` call for the
+    requests with highlight. The output is either the list of QA pairs or the exception raised for each request. """
+    output = [None] * len(list_model_input)
+    qa_group = {}
+    highlight_group = {}
+    for n, model_input in enumerate(list_model_input):
+        key = tuple(sorted(decoding_config(model_input).items()))
+        if model_input.highlight is None or len(model_input.highlight) == 0:
+            qa_group.setdefault(key, []).append(n)
+        else:
+            highlight_group.setdefault(key, []).append(n)
+
+    for key, index in qa_group.items():
+        try:
+            out = qg_model.generate_qa_batch([list_model_input[i].input_text for i in index], batch_size=BATCH_SIZE,
+                                             **dict(key))
+            for i, qa_list in zip(index, out):
+                if len(qa_list) == 0:
+                    output[i] = AnswerNotFoundError(list_model_input[i].input_text)
+                else:
+                    output[i] = qa_list
+        except Exception:
+            # fallback to process one by one to get the error of each request
+            for i in index:
+                try:
+                    output[i] = qg_model.generate_qa(list_model_input[i].input_text, batch_size=BATCH_SIZE,
+                                                     **dict(key))
+                except Exception as e:
+                    output[i] = e
+
+    for key, index in highlight_group.items():
+        try:
+            out = qg_model.generate_q([list_model_input[i].input_text for i in index],
+                                      list_answer=[list_model_input[i].highlight for i in index],
+                                      batch_size=BATCH_SIZE, **dict(key))
+            for i, q in zip(index, out):
+                output[i] = [(q, list_model_input[i].highlight)]
+        except Exception:
+            # fallback to process one by one to get the error of each request
+            for i in index:
+                try:
+                    out = qg_model.generate_q([list_model_input[i].input_text],
+                                              list_answer=[list_model_input[i].highlight],
+                                              **dict(key))
+                    output[i] = [(out[0], list_model_input[i].highlight)]
+                except Exception as e:
+                    output[i] = e
+    return output
+
+
+async def batch_worker():
+    """ Collect the requests in the queue for `BATCH_TIMEOUT` seconds (or until `MAX_BATCH` requests) and run the
+    model over them at once. """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await app.state.queue.get()]
+        deadline = loop.time() + BATCH_TIMEOUT
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(app.state.queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        logging.debug('process batch of {} requests'.format(len(batch)))
+        try:
+            output = await loop.run_in_executor(executor, generate, [model_input for model_input, _ in batch])
+        except Exception as e:
+            output = [e] * len(batch)
+        for (_, future), out in zip(batch, output):
+            if future.done():
+                continue
+            if isinstance(out, Exception):
+                future.set_exception(out)
+            else:
+                future.set_result(out)
 
 
 app = FastAPI()
@@ -38,6 +144,17 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def startup():
+    app.state.queue = asyncio.Queue()
+    app.state.batch_worker = asyncio.ensure_future(batch_worker())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.batch_worker.cancel()
+
+
 # Endpoint
 @app.get("/")
 def read_root():
@@ -57,14 +174,10 @@ async def info():
 async def process(model_input: ModelInput):
     if len(model_input.input_text) == 0:
         raise HTTPException(status_code=404, detail='Input text is empty string.')
+    future = asyncio.get_running_loop().create_future()
+    await app.state.queue.put((model_input, future))
     try:
-        if model_input.highlight is None or len(model_input.highlight) == 0:
-            qa_list = qg_model.generate_qa(model_input.input_text, num_beams=model_input.num_beam)
-        else:
-            out = qg_model.generate_q([model_input.input_text],
-                                      list_answer=[model_input.highlight],
-                                      num_beams=model_input.num_beam)
-            qa_list = [(out[0], model_input.highlight)]
+        qa_list = await future
         return {'qa': qa_list}
     except Exception:
         logging.exception('Error')
@@ -46,6 +46,10 @@ setup(
         'uvicorn',
         'pydantic'
     ],
+    extras_require={
+        'onnx': ['optimum[onnxruntime]'],
+        'onnx-gpu': ['optimum[onnxruntime-gpu]']
+    },
     python_requires='>=3.6',
     entry_points={
         'console_scripts': [
@@ -47,8 +47,7 @@ def evaluate_qg(model: str,
                 batch_size=batch,
                 num_beams=num_beams,
                 drop_overflow_text=False,
-                skip_overflow_error=True,
-                parallel=True)
+                skip_overflow_error=True)
             with open(path_hypothesis, 'w') as f:
                 f.write('\n'.join(output))
             with open(path_reference, 'w') as f:
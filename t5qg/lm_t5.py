@@ -1,12 +1,14 @@
 """ T5 model. """
 import itertools
+import math
 import os
 import logging
 import pickle
-import re
+import tempfile
+from collections import OrderedDict
 from typing import List, Dict
-from multiprocessing import Pool
 
+import numpy as np
 import torch
 from torch.nn import CrossEntropyLoss, functional
 import transformers
@@ -14,8 +16,8 @@ from .exceptions import ExceedMaxLengthError, HighlightNotFoundError, AnswerNotF
 from . import sentence_split
 
 CE_IGNORE_INDEX = -100
+MIN_LENGTH_BUCKET = 64
 
-os.environ["TOKENIZERS_PARALLELISM"] = "false"  # to turn off warning message
 TASK_PREFIX = {
     "ans_ext": "extract answers",
     "e2e_qg": "generate questions",
@@ -70,6 +72,28 @@ def load_language_model(model_name, cache_dir: str = None):
     return tokenizer, model, config
 
 
+def load_onnx_model(model, device: str = 'cpu'):
+    """ export the model to ONNX Runtime (requires `optimum[onnxruntime]`, or `optimum[onnxruntime-gpu]` for GPU) """
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    provider = 'CPUExecutionProvider'
+    if device == 'cuda':
+        if 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+            provider = 'CUDAExecutionProvider'
+        else:
+            logging.warning('CUDAExecutionProvider is not available (install `optimum[onnxruntime-gpu]`), the model '
+                            'runs on CPU')
+    # export from the model with the additional special tokens rather than the original checkpoint
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model.save_pretrained(tmp_dir)
+        return ORTModelForSeq2SeqLM.from_pretrained(tmp_dir, export=True, use_cache=True, provider=provider)
+
+
+def length_bucket(length: int, max_length: int):
+    """ Round up the sequence length to the power of two (from MIN_LENGTH_BUCKET to max_length). """
+    return min(max_length, max(MIN_LENGTH_BUCKET, 2 ** math.ceil(math.log2(max(length, 1)))))
+
+
 def label_smoothed_loss(logits, labels, epsilon):
     """ https://github.com/huggingface/transformers/blob/55bb4c06f7be141c6d895dbe1f11018dc8580b2d/src/transformers/trainer_pt_utils.py#L430 """
     log_probs = - functional.log_softmax(logits, dim=-1)
@@ -79,14 +103,14 @@ def label_smoothed_loss(logits, labels, epsilon):
     padding_mask = labels.eq(CE_IGNORE_INDEX)
     # In case the ignore_index is -100, the gather will fail, so we replace labels by 0. The padding_mask
     # will ignore them in any case.
-    labels.clamp_min_(0)
+    labels = labels.clamp_min(0)
 
     nll_loss = log_probs.gather(dim=-1, index=labels)
-    nll_loss.masked_fill_(padding_mask, 0.0)
+    nll_loss = nll_loss.masked_fill(padding_mask, 0.0)
 
     # works for fp16 input tensor too, by internally upcasting it to fp32
     smoothed_loss = log_probs.sum(dim=-1, keepdim=True, dtype=torch.float32)
-    smoothed_loss.masked_fill_(padding_mask, 0.0)
+    smoothed_loss = smoothed_loss.masked_fill(padding_mask, 0.0)
 
     # Take the mean over the label dimensions, then divide by the number of active elements (i.e. not-padded):
     num_active_elements = padding_mask.numel() - padding_mask.long().sum()
@@ -96,26 +120,22 @@ def label_smoothed_loss(logits, labels, epsilon):
 
 
 class Dataset(torch.utils.data.Dataset):
-    """ torch.utils.data.Dataset wrapper converting into tensor """
-    float_tensors = ['attention_mask']
+    """ torch.utils.data.Dataset wrapper of the encoded tensors """
 
-    def __init__(self, data: List):
+    def __init__(self, data: Dict):
+        # each item is just a view of the 2-D tensor encoded by EncodePlus.batch_encode_plus
         self.data = data
+        self.size = len(data['input_ids']) if 'input_ids' in data else 0
 
     def __len__(self):
-        return len(self.data)
-
-    def to_tensor(self, name, data):
-        if name in self.float_tensors:
-            return torch.tensor(data, dtype=torch.float32)
-        return torch.tensor(data, dtype=torch.long)
+        return self.size
 
     def __getitem__(self, idx):
-        return {k: self.to_tensor(k, v) for k, v in self.data[idx].items()}
+        return {k: v[idx] for k, v in self.data.items()}
 
 
 class EncodePlus:
-    """ Wrapper of encode_plus for multiprocessing. """
+    """ Wrapper of encode_plus. """
 
     def __init__(self,
                  tokenizer,
@@ -125,8 +145,8 @@ class EncodePlus:
                  skip_overflow_error: bool = False,
                  skip_highlight_error: bool = False,
                  task_prefix: str = None,
-                 padding: bool = True):
-        """ Wrapper of encode_plus for multiprocessing.
+                 padding: bool or str = True):
+        """ Wrapper of encode_plus.
 
         @param tokenizer: transforms.Tokenizer
         @param max_length: Input max length.
@@ -134,7 +154,8 @@ class EncodePlus:
         @param drop_overflow_text: Return None if the input sentence exceeds the max token length.
         @param skip_overflow_error: Raise error if the input sentence exceeds the max token length.
         @param task_prefix: Either of `qg`, `ans_ext`, `qa`.
-        @param padding: Pad the sequence to the max length.
+        @param padding: Pad the sequence to the max length (or to the longest input of the batch if `longest`, and
+            to the length bucket of the longest input if `bucket`).
         """
         assert task_prefix is None or task_prefix in TASK_PREFIX
         self.task_prefix = task_prefix
@@ -146,66 +167,177 @@ class EncodePlus:
         self.skip_overflow_error = skip_overflow_error
         self.skip_highlight_error = skip_highlight_error
 
+        # the task prefix is tokenized once here and prepended to the token ids of each input
+        self.prefix_ids = []
+        if self.task_prefix is not None:
+            self.prefix_ids = self.tokenizer.encode(
+                '{}:'.format(TASK_PREFIX[self.task_prefix]), add_special_tokens=False)
+        self.num_special_tokens = self.tokenizer.num_special_tokens_to_add()
+        # special tokens around the token ids (eg. `</s>` at the end for T5, and `<s>`/`</s>` around for BART)
+        sentinel = self.tokenizer.build_inputs_with_special_tokens([-1])
+        self.special_prefix_ids = sentinel[:sentinel.index(-1)]
+        self.special_suffix_ids = sentinel[sentinel.index(-1) + 1:]
+
         # truncation should be true for the batch process, but not necessary to process single input
         self.param_in = {'truncation': True, 'max_length': self.max_length}
         self.param_out = {'truncation': True, 'max_length': self.max_length_output}
         self.padding = padding
-        if self.padding:
+        if self.padding:  # `longest`/`bucket` is for batch_encode_plus, and single input is padded to max_length
             self.param_in['padding'] = 'max_length'
             self.param_out['padding'] = 'max_length'
 
-    def __call__(self, inputs):
-        return self.encode_plus(*inputs)
+    def add_highlight(self, input_sequence: str, input_highlight: str = None):
+        """ Add the highlight tokens around the highlight phrase in the input. """
+        if input_highlight is None:
+            return input_sequence
+        position = input_sequence.find(input_highlight)
+        if position == -1:
+            if self.skip_highlight_error:
+                return None
+            raise HighlightNotFoundError(input_highlight, input_sequence)
+        return '{0}{1} {2} {1}{3}'.format(
+            input_sequence[:position], ADDITIONAL_SP_TOKENS['hl'], input_highlight,
+            input_sequence[position+len(input_highlight):])
+
+    def overflow_mask(self, length_input: List, length_output: List = None):
+        """ Mask of the sequence that exceeds the max_length given the number of tokens (without special tokens).
+
+        @param length_input: List of the number of tokens in the input.
+        @param length_output: List of the number of tokens in the output.
+        @return: numpy array of bool (True for the overflow).
+        """
+        mask = np.zeros(len(length_input), dtype=bool)
+        if self.drop_overflow_text or not self.skip_overflow_error:
+            mask = np.asarray(length_input) + self.num_special_tokens > self.max_length
+            if mask.any() and not self.drop_overflow_text:
+                raise ExceedMaxLengthError(self.max_length)
+            if length_output is not None:
+                mask_output = np.asarray(length_output) + self.num_special_tokens > self.max_length_output
+                if mask_output.any() and not self.drop_overflow_text:
+                    raise ExceedMaxLengthError(self.max_length_output)
+                mask |= mask_output
+        return mask
+
+    def prepare_for_model(self, input_ids: List, output_ids: List = None):
+        """ Convert the token ids (without special tokens) into the model input. """
+        encode = self.tokenizer.prepare_for_model(input_ids, **self.param_in)
+        if output_ids is not None:
+            encode['labels'] = self.tokenizer.prepare_for_model(output_ids, **self.param_out)['input_ids']
+        return encode
 
     def encode_plus(self, input_sequence: str, output_sequence: str = None, input_highlight: str = None):
+        input_sequence = self.add_highlight(input_sequence, input_highlight)
+        if input_sequence is None:
+            return None
+        # tokenize once and reuse the token ids for both of the overflow check and the encoding
+        input_ids = self.prefix_ids + self.tokenizer.encode(input_sequence, add_special_tokens=False)
+        output_ids = None
+        if output_sequence is not None:
+            output_ids = self.tokenizer.encode(output_sequence, add_special_tokens=False)
+        # remove sentence that exceeds the max_length
+        if self.overflow_mask([len(input_ids)], None if output_ids is None else [len(output_ids)])[0]:
+            return None
+        return self.prepare_for_model(input_ids, output_ids)
 
-        # add highlight to the input
-        if input_highlight is not None:
-            position = input_sequence.find(input_highlight)
-            if position == -1:
-                if self.skip_highlight_error:
-                    return None
-                raise HighlightNotFoundError(input_highlight, input_sequence)
-            input_sequence = '{0}{1} {2} {1}{3}'.format(
-                input_sequence[:position], ADDITIONAL_SP_TOKENS['hl'], input_highlight,
-                input_sequence[position+len(input_highlight):])
+    def pad(self, list_ids: List, max_length: int, prefix_ids: List = None):
+        """ Add the prefix and the special tokens to the token ids (truncated to fit in the max_length), and pad them
+        into 2-D array at once without processing each sequence one by one.
 
-        if self.task_prefix is not None:
-            input_sequence = '{}: {}'.format(TASK_PREFIX[self.task_prefix], input_sequence)
+        @param list_ids: List of the token ids (without special tokens).
+        @param max_length: Length to pad the sequences.
+        @param prefix_ids: Token ids to prepend to each sequence.
+        @return: torch.Tensor of `input_ids` and `attention_mask`.
+        """
+        head = self.special_prefix_ids + (prefix_ids or [])
+        tail = self.special_suffix_ids
+        size = len(list_ids)
+        length = np.fromiter(map(len, list_ids), dtype=np.int64, count=size)
+        flat_ids = np.fromiter(itertools.chain.from_iterable(list_ids), dtype=np.int64, count=length.sum())
+        # row and position in the row of each token of the flatten ids
+        row = np.repeat(np.arange(size), length)
+        col = np.arange(len(flat_ids)) - np.repeat(np.cumsum(length) - length, length)
+        # truncate the tokens that exceed the max_length
+        max_length_body = max(max_length - len(head) - len(tail), 0)
+        keep = col < max_length_body
+        length = np.minimum(length, max_length_body)
+
+        input_ids = np.full((size, max_length), self.tokenizer.pad_token_id, dtype=np.int64)
+        input_ids[:, :len(head)] = head
+        input_ids[row[keep], col[keep] + len(head)] = flat_ids[keep]
+        input_ids[np.arange(size)[:, None], (length + len(head))[:, None] + np.arange(len(tail))] = tail
+        attention_mask = np.arange(max_length) < (length + len(head) + len(tail))[:, None]
+        return torch.from_numpy(input_ids), torch.from_numpy(attention_mask.astype(np.int64))
+
+    def batch_encode_plus(self, data: List):
+        """ Encode list of (input, output, highlight) with a single call of the (fast) tokenizer over the batch.
+
+        @param data: List of tuple of input, output (None for all if no output) and optionally highlight (or None).
+        @return: transformers.BatchEncoding of tensor (the input dropped by the overflow/highlight check is removed).
+        """
+        data = [(self.add_highlight(d[0], d[2] if len(d) > 2 else None), d[1]) for d in data]
+        data = [d for d in data if d[0] is not None]
+        if len(data) == 0:
+            return transformers.BatchEncoding({})
+        encode_input = self.tokenizer([i for i, _ in data], add_special_tokens=False, return_length=True)
+        length_input = np.asarray(encode_input['length']) + len(self.prefix_ids)
+        length_output = None
+        if data[0][1] is not None:
+            encode_output = self.tokenizer([o for _, o in data], add_special_tokens=False, return_length=True)
+            length_output = np.asarray(encode_output['length'])
 
         # remove sentence that exceeds the max_length
-        if self.drop_overflow_text or not self.skip_overflow_error:
-            if len(self.tokenizer.encode(input_sequence)) > self.max_length:
-                if self.drop_overflow_text:
-                    return None
-                raise ExceedMaxLengthError(self.max_length)
-            if output_sequence is not None:
-                if len(self.tokenizer.encode(output_sequence)) > self.max_length_output:
-                    if self.drop_overflow_text:
-                        return None
-                    raise ExceedMaxLengthError(self.max_length)
-        encode = self.tokenizer.encode_plus(input_sequence, **self.param_in)
-        if output_sequence is not None:
-            encode['labels'] = self.tokenizer.encode(output_sequence, **self.param_out)
-        return encode
+        index = np.flatnonzero(~self.overflow_mask(length_input, length_output))
+        if len(index) == 0:
+            return transformers.BatchEncoding({})
+        max_length = self.max_length
+        if self.padding in ['longest', 'bucket'] or not self.padding:  # no padding still needs 2-D tensor
+            max_length = int(min(self.max_length, length_input[index].max() + self.num_special_tokens))
+            if self.padding == 'bucket':
+                max_length = length_bucket(max_length, self.max_length)
+        input_ids, attention_mask = self.pad(
+            [encode_input['input_ids'][i] for i in index], max_length, prefix_ids=self.prefix_ids)
+        encode = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if length_output is not None:
+            max_length_output = self.max_length_output
+            if not self.padding:
+                max_length_output = int(min(
+                    self.max_length_output, length_output[index].max() + self.num_special_tokens))
+            encode['labels'] = self.pad([encode_output['input_ids'][i] for i in index], max_length_output)[0]
+        return transformers.BatchEncoding(encode)
 
 
 class T5:
     """ T5 model. """
 
     def __init__(self, model: str, max_length: int = 512, max_length_output: int = 32, cache_dir: str = None,
-                 label_smoothing: float = None):
+                 label_smoothing: float = None, compile_model: bool = False, quantization: str = None,
+                 qa_cache_size: int = 1024, onnx: bool = False, warmup_num_beams: int = 4,
+                 warmup_batch_size: int = 1, half_precision: str = None):
         """ T5 model.
 
         @param model: path to the checkpoint or alias on huggingface modelhub.
         @param max_length: Max sequence length for the input.
         @param max_length_output: Max sequence length for the output.
         @param cache_dir:
+        @param compile_model: Compile the model with static kv cache for the generation (inference only). The cuda
+            graph is kept per thread, so the generation should run on the thread where the model is instantiated.
+        @param quantization: `int8` to quantize the linear layers dynamically (CPU inference only).
+        @param qa_cache_size: Number of the `generate_qa`/`generate_qa_batch` output to memoize (0 to disable).
+        @param onnx: Run the model with ONNX Runtime (inference only).
+        @param warmup_num_beams: Number of beam to warmup the compiled model with (the one used for serving).
+        @param warmup_batch_size: Max batch size to warmup the compiled model with (the batch is padded to the power
+            of two), and the larger batch runs without the compiled model.
+        @param half_precision: `bf16` or `fp16` to run the generation with autocast (GPU inference only). Note that T5
+            can overflow in fp16, and the output differs from the one in fp32.
         """
         self.model_name = model
         self.max_length = max_length
         self.max_length_output = max_length_output
         self.label_smoothing = label_smoothing
+        # fuse the element-wise ops over the vocabulary into a few kernels if torch.compile is available (torch>=2.0)
+        self.label_smoothed_loss = label_smoothed_loss
+        if self.label_smoothing and hasattr(torch, 'compile'):
+            self.label_smoothed_loss = torch.compile(label_smoothed_loss, dynamic=True)
         logging.info('instantiate T5 model class with `{}`'.format(self.model_name))
         self.tokenizer, self.model, config = load_language_model(self.model_name, cache_dir=cache_dir)
         self.no_prefix = False
@@ -215,30 +347,117 @@ class T5:
         # GPU setup
         self.device = 'cuda' if torch.cuda.device_count() > 0 else 'cpu'
         self.parallel = False
-        if torch.cuda.device_count() > 1:
-            self.parallel = True
-            self.model = torch.nn.DataParallel(self.model)
-        self.model.to(self.device)
+        self.onnx = onnx
+        if self.onnx:
+            assert not compile_model and quantization is None, 'ONNX Runtime model can not be compiled/quantized'
+            logging.info('export model to ONNX Runtime')
+            self.model = load_onnx_model(self.model, self.device)
+            self.device = self.model.device.type  # CPU if the CUDA provider is not available
+        else:
+            if torch.cuda.device_count() > 1:
+                self.parallel = True
+                self.model = torch.nn.DataParallel(self.model)
+            self.model.to(self.device)
         logging.info('{} GPUs are in use'.format(torch.cuda.device_count()))
+        self.quantization = None
+        if quantization is not None:
+            assert quantization == 'int8', 'unknown quantization: {}'.format(quantization)
+            assert not compile_model, 'quantized model can not be compiled'
+            if self.device == 'cpu':
+                logging.info('quantize linear layers to int8')
+                self.quantization = quantization
+                self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            else:
+                logging.warning('int8 quantization is only supported on CPU, the model is not quantized')
+        if self.device == 'cuda':
+            torch.backends.cudnn.benchmark = True
+        # half precision for the generation (weights are kept in fp32 so that the model can still be trained)
+        self.autocast_dtype = None
+        if half_precision is not None:
+            assert half_precision in ['bf16', 'fp16'], 'unknown half_precision: {}'.format(half_precision)
+            if self.device != 'cuda':
+                logging.warning('half precision is only supported on GPU, the model runs in fp32')
+            elif half_precision == 'bf16' and not torch.cuda.is_bf16_supported():
+                logging.warning('bf16 is not supported on the GPU, the model runs in fp32')
+            else:
+                self.autocast_dtype = torch.bfloat16 if half_precision == 'bf16' else torch.float16
+
+        # static kv cache and compiled forward for the generation
+        self.compile_model = compile_model
+        if self.compile_model:
+            model = self.model.module if self.parallel else self.model
+            # torch.compile needs torch>=2.0 and the static kv cache needs the model class supporting it
+            static_cache = hasattr(transformers, 'StaticCache') and (
+                getattr(model, '_supports_static_cache', False) or getattr(model, '_can_compile_fullgraph', False))
+            if not hasattr(torch, 'compile') or not static_cache:
+                logging.warning('torch.compile or static kv cache is not supported (torch {}, transformers {}), the '
+                                'model runs without compile'.format(torch.__version__, transformers.__version__))
+                self.compile_model = False
+        self.warmup_num_beams = warmup_num_beams
+        self.warmup_batch_size = warmup_batch_size
+        if self.compile_model:
+            import torch._dynamo
+            model.generation_config.cache_implementation = 'static'
+            if hasattr(model.generation_config, 'disable_compile'):  # compiled here instead of the one by `generate`
+                model.generation_config.disable_compile = True
+            # the cuda graph is captured for each pair of the batch bucket and length bucket with `warmup_num_beams`
+            # here, and the input of the other shape runs with the eager forward (see `generate_tensor`)
+            list_batch = [2 ** i for i in range(math.ceil(math.log2(max(self.warmup_batch_size, 1))) + 1)]
+            list_length = sorted(set(
+                length_bucket(2 ** i, self.max_length) for i in range(math.ceil(math.log2(self.max_length)) + 1)))
+            torch._dynamo.config.cache_size_limit = max(
+                torch._dynamo.config.cache_size_limit, len(list_batch) * len(list_length))
+            self.__forward_eager = model.forward
+            self.__forward_compiled = torch.compile(model.forward, mode='reduce-overhead', fullgraph=True, dynamic=False)
+            self.eval()
+            for batch, length in itertools.product(list_batch, list_length):
+                logging.info('warmup the compiled model (batch: {}, length: {}, num_beams: {})'.format(
+                    batch, length, self.warmup_num_beams))
+                self.generate_tensor({'input_ids': torch.ones(batch, length, dtype=torch.long),
+                                      'attention_mask': torch.ones(batch, length, dtype=torch.long)},
+                                     num_beams=self.warmup_num_beams)
 
         # for answer extraction model
         self.sentence_splitter = sentence_split.SentSplit()
 
+        # memoize the output of generate_qa/generate_qa_batch for the same input (LRU)
+        self.qa_cache_size = qa_cache_size
+        self.__qa_cache = OrderedDict()
+
+    def __qa_cache_get(self, key):
+        if key not in self.__qa_cache:
+            return None
+        self.__qa_cache.move_to_end(key)
+        return self.__qa_cache[key]
+
+    def __qa_cache_set(self, key, value):
+        if self.qa_cache_size == 0:
+            return
+        self.__qa_cache[key] = value
+        if len(self.__qa_cache) > self.qa_cache_size:
+            self.__qa_cache.popitem(last=False)
+
     def train(self):
+        # the model is going to be updated, so the memoized output is not valid anymore
+        self.__qa_cache.clear()
+        assert not self.onnx, 'ONNX Runtime model can not be trained'
+        assert self.quantization is None, 'quantized model can not be trained'
         self.model.train()
 
     def eval(self):
-        self.model.eval()
+        if not self.onnx:
+            self.model.eval()
 
     def generate_qa(self,
                     context: str,
                     drop_overflow_text: bool = False,
                     skip_overflow_error: bool = False,
-                    parallel: bool = False,
                     batch_size: int = None,
                     num_beams: int = 4,
                     num_workers: int = 0,
-                    cache_path: str = None):
+                    cache_path: str = None,
+                    early_stopping: bool = False,
+                    no_repeat_ngram_size: int = None):
         """ Generate question given context.
 
         @param context: Input context.
@@ -246,33 +465,117 @@ class T5:
         @param skip_overflow_error: Raise error if the input sentence exceeds the max token length.
         @param batch_size: Batch size.
         @param num_beams: Number of beam for model generation.
+        @param early_stopping: Stop the beam search when all the beams reach the end of sentence.
+        @param no_repeat_ngram_size: Prevent the ngram of this size from appearing twice in the generation (applied
+            to the question generation only, as the answer is a span of the context).
         @param num_workers:
         @param cache_path:
         @return: List of generated sentences.
         """
+        key = (context, drop_overflow_text, skip_overflow_error, num_beams, early_stopping, no_repeat_ngram_size)
+        output = self.__qa_cache_get(key)
+        if output is not None:
+            return list(output)
         logging.info('running model for `ans_ext`')
         list_answer = self.generate_a(
             context, drop_overflow_text=drop_overflow_text, batch_size=batch_size, num_beams=num_beams,
             skip_overflow_error=skip_overflow_error, num_workers=num_workers, cache_path=cache_path,
-            parallel=parallel)
+            early_stopping=early_stopping)
         list_context = [context] * len(list_answer)
         logging.info('running model for `qg`')
         list_question = self.generate_q(
             list_context, list_answer=list_answer, drop_overflow_text=drop_overflow_text, batch_size=batch_size,
             skip_overflow_error=skip_overflow_error, num_workers=num_workers, cache_path=cache_path,
-            num_beams=num_beams, parallel=parallel)
+            num_beams=num_beams, early_stopping=early_stopping, no_repeat_ngram_size=no_repeat_ngram_size)
         assert len(list_answer) == len(list_question)
-        return list(zip(list_question, list_answer))
+        output = tuple(zip(list_question, list_answer))
+        self.__qa_cache_set(key, output)
+        return list(output)
+
+    def generate_qa_batch(self,
+                          list_context: List,
+                          batch_size: int = None,
+                          num_beams: int = 4,
+                          early_stopping: bool = False,
+                          no_repeat_ngram_size: int = None):
+        """ Generate question and answer pairs over multiple contexts, where the model runs once for `ans_ext` over
+        all the sentences of all the contexts and once for `qg` over all the extracted answers.
+
+        @param list_context: List of input context.
+        @param batch_size: Batch size.
+        @param num_beams: Number of beam for model generation.
+        @param early_stopping: Stop the beam search when all the beams reach the end of sentence.
+        @param no_repeat_ngram_size: Prevent the ngram of this size from appearing twice in the generation (applied
+            to the question generation only, as the answer is a span of the context).
+        @return: List of the generated QA pairs of each context (empty list if no answer is found in the context).
+        """
+        assert not self.no_prefix, 'model is not trained for answer extraction'
+        list_key = [(c, False, False, num_beams, early_stopping, no_repeat_ngram_size) for c in list_context]
+        output = [self.__qa_cache_get(k) for k in list_key]
+        index = [n for n, o in enumerate(output) if o is None]
+        if len(index) == 0:
+            return [list(o) for o in output]
+
+        logging.info('running model for `ans_ext`')
+        list_sentence = [self.split_sentence(list_context[n]) for n in index]
+        list_answer = [[] for _ in index]
+        flat_sentence = list(itertools.chain(*list_sentence))
+        if len(flat_sentence) > 0:
+            out = self.generate_prediction(
+                [list_context[n] for n, s in zip(index, list_sentence) for _ in s], list_highlight=flat_sentence,
+                task_type='ans_ext', num_beams=num_beams, batch_size=batch_size, early_stopping=early_stopping)
+            start = 0
+            for i, (n, s) in enumerate(zip(index, list_sentence)):
+                list_answer[i] = self.filter_answer(out[start:start + len(s)], list_context[n])
+                start += len(s)
+
+        logging.info('running model for `qg`')
+        list_question = []
+        flat_answer = list(itertools.chain(*list_answer))
+        if len(flat_answer) > 0:
+            list_question = self.generate_q(
+                [list_context[n] for n, a in zip(index, list_answer) for _ in a], list_answer=flat_answer,
+                num_beams=num_beams, batch_size=batch_size, early_stopping=early_stopping,
+                no_repeat_ngram_size=no_repeat_ngram_size)
+        assert len(flat_answer) == len(list_question)
+        start = 0
+        for n, a in zip(index, list_answer):
+            output[n] = tuple(zip(list_question[start:start + len(a)], a))
+            start += len(a)
+            if len(a) > 0:
+                self.__qa_cache_set(list_key[n], output[n])
+        return [list(o) for o in output]
+
+    @staticmethod
+    def clean(string):
+        string = string.strip()
+        if len(string) > 0:
+            return string
+        return None
+
+    def split_sentence(self, context: str):
+        """ Split the context into the sentences (empty sentence is removed, as it would be fed without highlight).
+        """
+        return list(filter(None, map(self.clean, self.sentence_splitter(context))))
+
+    def filter_answer(self, list_answer: List, context: str):
+        """ Remove the empty answer and the answer out of context from the `ans_ext` output. """
+        # out = list(itertools.chain(*[[clean(ii) for ii in i.split(ADDITIONAL_SP_TOKENS['sep'])] for i in out]))
+        list_answer = list(filter(None, map(self.clean, list_answer)))
+        # remove answer out of context (search each unique candidate once)
+        in_context = {i for i in set(list_answer) if i in context}
+        return [i for i in list_answer if i in in_context]
 
     def generate_a(self,
                    context: str,
                    drop_overflow_text: bool = False,
                    skip_overflow_error: bool = False,
-                   parallel: bool = False,
                    batch_size: int = None,
                    num_beams: int = 4,
                    num_workers: int = 0,
-                   cache_path: str = None):
+                   cache_path: str = None,
+                   early_stopping: bool = False,
+                   no_repeat_ngram_size: int = None):
         """ Generate answer candidate in each sentence.
 
         @param context: Input document.
@@ -280,31 +583,28 @@ class T5:
         @param skip_overflow_error: Raise error if the input sentence exceeds the max token length.
         @param batch_size: Batch size.
         @param num_beams: Number of beam for model generation.
+        @param early_stopping: Stop the beam search when all the beams reach the end of sentence.
+        @param no_repeat_ngram_size: Prevent the ngram of this size from appearing twice in the generation.
         @param num_workers:
         @param cache_path:
         @return: List of generated answer.
         """
         assert not self.no_prefix, 'model is not trained for answer extraction'
-
-        def clean(string):
-            string = re.sub(r'\A\s*', '', string)
-            string = re.sub(r'\s*\Z', '', string)
-            if len(string) > 0:
-                return string
-            return None
-
         # list_context = process_for_ans_ext(context)
-        list_sentence = [clean(i) for i in self.sentence_splitter(context)]
-        list_context = [context] * len(list_sentence)
+        list_sentence = self.split_sentence(context)
+        if len(list_sentence) == 0:
+            raise AnswerNotFoundError(context)
 
+        # all the sentences are processed in a single batch by default, in which case no worker is needed
+        if batch_size is None:
+            batch_size = len(list_sentence)
+            num_workers = 0
         out = self.generate_prediction(
-            list_context, list_highlight=list_sentence, task_type='ans_ext', drop_overflow_text=drop_overflow_text,
-            skip_overflow_error=skip_overflow_error, num_workers=num_workers, cache_path=cache_path,
-            num_beams=num_beams, batch_size=batch_size, parallel=parallel)
-        # out = list(itertools.chain(*[[clean(ii) for ii in i.split(ADDITIONAL_SP_TOKENS['sep'])] for i in out]))
-        out = [clean(i) for i in out]
-        out = list(filter(None, out))  # remove None
-        out = list(filter(lambda x: x in context, out))  # remove answer out of context
+            [context] * len(list_sentence), list_highlight=list_sentence, task_type='ans_ext',
+            drop_overflow_text=drop_overflow_text, skip_overflow_error=skip_overflow_error, num_workers=num_workers,
+            cache_path=cache_path, num_beams=num_beams, batch_size=batch_size, early_stopping=early_stopping,
+            no_repeat_ngram_size=no_repeat_ngram_size)
+        out = self.filter_answer(out, context)
         if len(out) == 0:
             raise AnswerNotFoundError(context)
         return out
@@ -314,11 +614,12 @@ class T5:
                    list_answer: List or None = None,
                    drop_overflow_text: bool = False,
                    skip_overflow_error: bool = False,
-                   parallel: bool = False,
                    batch_size: int = None,
                    num_beams: int = 4,
                    num_workers: int = 0,
-                   cache_path: str = None):
+                   cache_path: str = None,
+                   early_stopping: bool = False,
+                   no_repeat_ngram_size: int = None):
         """ Generate question given context. Note that the answer should be either already highlighted in the context
         eg) "I live in <hl> Tokyo <hl>."
         or given by list_answer.
@@ -329,6 +630,8 @@ class T5:
         @param skip_overflow_error: Raise error if the input sentence exceeds the max token length.
         @param batch_size: Batch size.
         @param num_beams: Number of beam for model generation.
+        @param early_stopping: Stop the beam search when all the beams reach the end of sentence.
+        @param no_repeat_ngram_size: Prevent the ngram of this size from appearing twice in the generation.
         @param num_workers:
         @param cache_path:
         @return: List of generated sentences.
@@ -336,7 +639,8 @@ class T5:
         return self.generate_prediction(
             list_context, list_highlight=list_answer, task_type='qg', drop_overflow_text=drop_overflow_text,
             skip_overflow_error=skip_overflow_error, num_workers=num_workers, cache_path=cache_path,
-            num_beams=num_beams, batch_size=batch_size, parallel=parallel)
+            num_beams=num_beams, batch_size=batch_size, early_stopping=early_stopping,
+            no_repeat_ngram_size=no_repeat_ngram_size)
 
     def generate_prediction(self,
                             list_context: List,
@@ -345,11 +649,12 @@ class T5:
                             drop_overflow_text: bool = False,
                             skip_overflow_error: bool = False,
                             skip_highlight_error: bool = False,
-                            parallel: bool = False,
                             batch_size: int = None,
                             num_beams: int = 4,
                             num_workers: int = 0,
-                            cache_path: str = None):
+                            cache_path: str = None,
+                            early_stopping: bool = False,
+                            no_repeat_ngram_size: int = None):
         """ General method to generate model prediction
 
         @param list_context: List of input sentences.
@@ -359,6 +664,8 @@ class T5:
         @param skip_overflow_error: Raise error if the input sentence exceeds the max token length.
         @param batch_size: Batch size.
         @param num_beams: Number of beam for model generation.
+        @param early_stopping: Stop the beam search when all the beams reach the end of sentence.
+        @param no_repeat_ngram_size: Prevent the ngram of this size from appearing twice in the generation.
         @param num_workers:
         @param cache_path:
         @return: List of generated sentences.
@@ -374,25 +681,53 @@ class T5:
                                       batch_size=batch_size,
                                       num_workers=num_workers,
                                       cache_path=cache_path,
-                                      skip_highlight_error=skip_highlight_error,
-                                      parallel=parallel)
+                                      skip_highlight_error=skip_highlight_error)
         outputs = []
         for encode in loader:
-            with torch.no_grad():
-                encode = {k: v.to(self.device) for k, v in encode.items()}
-                encode['max_length'] = self.max_length_output
-                encode['num_beams'] = num_beams
-                tensor = self.model.module.generate(**encode) if self.parallel else self.model.generate(**encode)
-                outputs += self.tokenizer.batch_decode(tensor, skip_special_tokens=True)
+            tensor = self.generate_tensor(
+                encode, num_beams=num_beams, early_stopping=early_stopping, no_repeat_ngram_size=no_repeat_ngram_size)
+            outputs += self.tokenizer.batch_decode(tensor, skip_special_tokens=True)
         return outputs
 
+    def generate_tensor(self, encode: Dict, num_beams: int = 4, early_stopping: bool = False,
+                        no_repeat_ngram_size: int = None):
+        """ Run model generation over a batch of encoded input and return the generated token ids. """
+        with torch.inference_mode(), torch.autocast(
+                device_type=self.device, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None):
+            encode = {k: v.to(self.device, non_blocking=True) for k, v in encode.items()}
+            batch_size, length = encode['input_ids'].shape
+            model = self.model.module if self.parallel else self.model
+            if self.compile_model:
+                # replay the cuda graph captured at the warmup if the input is in the shape, otherwise run eager
+                compiled = num_beams == self.warmup_num_beams and batch_size <= self.warmup_batch_size and \
+                    length == length_bucket(length, self.max_length)
+                if compiled:
+                    # pad the batch to the power of two with the copy of the first input
+                    pad = 2 ** math.ceil(math.log2(batch_size)) - batch_size
+                    encode = {k: torch.cat([v, v[:1].expand(pad, -1)]) for k, v in encode.items()}
+                model.forward = self.__forward_compiled if compiled else self.__forward_eager
+            encode['max_length'] = self.max_length_output
+            encode['num_beams'] = num_beams
+            if no_repeat_ngram_size is not None:
+                encode['no_repeat_ngram_size'] = no_repeat_ngram_size
+            if early_stopping and num_beams > 1:
+                encode['early_stopping'] = True
+            return model.generate(**encode)[:batch_size]
+
     def encode_to_loss(self, encode: Dict):
         assert 'labels' in encode
-        output = self.model(**{k: v.to(self.device) for k, v in encode.items()})
+        encode = {k: v.to(self.device, non_blocking=True) for k, v in encode.items()}
+        output = self.model(**encode)
         if self.label_smoothing is None or self.label_smoothing == 0.0:
             return output['loss'].mean() if self.parallel else output['loss']
-        else:
-            return label_smoothed_loss(output['logits'], encode['labels'].to(self.device), self.label_smoothing)
+        if self.label_smoothed_loss is not label_smoothed_loss:
+            try:
+                return self.label_smoothed_loss(output['logits'], encode['labels'], self.label_smoothing)
+            except torch._dynamo.exc.BackendCompilerFailed:
+                # compilation failed (eg. no compiler toolchain for inductor), but the other error (eg. OOM) is raised
+                logging.exception('failed to compile label_smoothed_loss, fallback to eager mode')
+                self.label_smoothed_loss = label_smoothed_loss
+        return self.label_smoothed_loss(output['logits'], encode['labels'], self.label_smoothing)
 
     def get_data_loader(self,
                         inputs,
@@ -406,8 +741,7 @@ class T5:
                         cache_path: str = None,
                         drop_overflow_text: bool = False,
                         skip_overflow_error: bool = False,
-                        skip_highlight_error: bool = False,
-                        parallel: bool = False):
+                        skip_highlight_error: bool = False):
         """ Transform features (produced by BERTClassifier.preprocess method) to data loader.
 
         @param inputs: List of input sentences.
@@ -439,32 +773,28 @@ class T5:
             else:
                 raise ValueError('model is not trained with prefix')
 
+        out = None
         if cache_path is not None and os.path.exists(cache_path):
             logging.info('loading preprocessed feature from {}'.format(cache_path))
             out = pickle_load(cache_path)
-        else:
-            # process in parallel
+            if not isinstance(out, transformers.BatchEncoding):
+                # the cache saved by the older version is a list of encodings
+                logging.warning('preprocessed feature at {} is in an old format, re-encode the data'.format(cache_path))
+                out = None
+        if out is None:
             config = {'tokenizer': self.tokenizer, 'max_length': self.max_length,
                       'max_length_output': self.max_length_output, 'drop_overflow_text': drop_overflow_text,
                       'task_prefix': task_prefix, 'skip_overflow_error': skip_overflow_error,
                       'skip_highlight_error': skip_highlight_error}
-            if len(data) == 1:
-                config['padding'] = False
-
-            if parallel:
-                pool = Pool()
-                out = pool.map(EncodePlus(**config), data)
-                pool.close()
-            else:
-                f = EncodePlus(**config)
-                out = []
-                for i in data:
-                    out.append(f(i))
+            if outputs is None:
+                # no need to pad up to the max_length for the inference, but the compiled model needs the input in
+                # the length bucket to reuse the cuda graph
+                config['padding'] = 'bucket' if self.compile_model else 'longest'
 
-            # remove overflow text
-            logging.info('encode all the data       : {}'.format(len(out)))
-            out = list(filter(None, out))
-            logging.info('after remove the overflow : {}'.format(len(out)))
+            # single call of the batched tokenizer, which runs in parallel internally
+            out = EncodePlus(**config).batch_encode_plus(data)
+            logging.info('encode all the data       : {}'.format(len(data)))
+            logging.info('after remove the overflow : {}'.format(len(out.get('input_ids', []))))
 
             # cache the encoded data
             if cache_path is not None:
@@ -472,9 +802,11 @@ class T5:
                 pickle_save(out, cache_path)
                 logging.info('preprocessed feature is saved at {}'.format(cache_path))
 
-        batch_size = len(out) if batch_size is None else batch_size
+        dataset = Dataset(out)
+        batch_size = len(dataset) if batch_size is None else batch_size
         return torch.utils.data.DataLoader(
-            Dataset(out), batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, drop_last=drop_last)
+            dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, drop_last=drop_last,
+            pin_memory=self.device == 'cuda')
 
     def save(self, save_dir):
         if self.parallel: